@@ -7,16 +7,82 @@ Official Repo: https://github.com/Wan-Video/Wan2.2
 """
 
 import runpod
+import asyncio
+import copy
+import functools
+import mmap
 import os
-import sys
-import base64
-import subprocess
+import random
 import tempfile
-import json
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 from pathlib import Path
 
-# Model paths
-MODELS_DIR = Path("/workspace")  # Models stored here
+# Multi-connection Rust downloader for model downloads
+# (must be set before huggingface_hub is imported)
+os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+
+import imageio
+import pybase64
+import torch
+from PIL import Image, ImageOps
+from huggingface_hub import snapshot_download
+from turbojpeg import TurboJPEG, TJPF_RGB
+
+# Official Wan 2.2 package (on PYTHONPATH via /workspace/Wan2.2)
+import wan
+from wan.configs import WAN_CONFIGS, SIZE_CONFIGS, MAX_AREA_CONFIGS, SUPPORTED_SIZES
+
+# Model paths (RunPod mounts network volumes at /runpod-volume)
+DEFAULT_MODELS_DIR = "/runpod-volume" if Path("/runpod-volume").is_dir() else "/workspace"
+MODELS_DIR = Path(os.environ.get("WAN_MODELS_DIR", DEFAULT_MODELS_DIR))
+WAN_DIR = Path("/workspace/Wan2.2")
+OUTPUT_DIR = Path(tempfile.gettempdir())
+
+# Optional object storage for outputs (RunPod bucket env var names)
+BUCKET_NAME = os.environ.get("BUCKET_NAME")
+BUCKET_URL_EXPIRY = int(os.environ.get("BUCKET_URL_EXPIRY", "86400"))
+
+def create_s3_client():
+    """Create the bucket client (boto3 is only imported when a bucket is configured)"""
+    import boto3
+    
+    return boto3.client(
+        "s3",
+        endpoint_url=os.environ.get("BUCKET_ENDPOINT_URL"),
+        aws_access_key_id=os.environ.get("BUCKET_ACCESS_KEY_ID"),
+        aws_secret_access_key=os.environ.get("BUCKET_SECRET_ACCESS_KEY")
+    )
+
+S3_CLIENT = create_s3_client() if BUCKET_NAME else None
+
+# Opt-in: concurrent jobs for the same model are grouped within a short window
+# and run back-to-back. Grouped jobs queue behind each other on one GPU, so
+# their RunPod execution timeout keeps running (default 1 = no grouping)
+BATCH_WINDOW_MS = int(os.environ.get("WAN_BATCH_WINDOW_MS", "100"))
+MAX_BATCH_SIZE = int(os.environ.get("WAN_MAX_BATCH_SIZE", "1"))
+
+# Optional weight-only quantization of the DiT: "int8" or "fp8" (Hopper/Ada)
+WAN_QUANT = os.environ.get("WAN_QUANT", "").lower()
+
+# torch.compile the DiT once after load and warm it at startup
+# Accepted sizes are pinned to default_size/alt_size to avoid recompiles
+WAN_COMPILE = os.environ.get("WAN_COMPILE", "0") == "1"
+WARMUP_STEPS = 4
+
+# Reuse the T5 encoder / VAE across loaded models when their checkpoints match
+WAN_SHARE_COMPONENTS = os.environ.get("WAN_SHARE_COMPONENTS", "0") == "1"
+
+# Encoded prompts kept per text encoder (0 disables the cache)
+PROMPT_CACHE_SIZE = int(os.environ.get("WAN_PROMPT_CACHE_SIZE", "64"))
+
+# One GPU thread so groups never overlap on the device
+GPU_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+
+# CPU threads for MP4 encoding, overlapping with the next job's diffusion
+WRITER_EXECUTOR = ThreadPoolExecutor(max_workers=2)
 
 # Model configurations from official docs
 MODEL_CONFIGS = {
@@ -27,49 +93,50 @@ MODEL_CONFIGS = {
         "supports_t2v": True,
         "supports_i2v": True,
         "vram": "24GB",
-        "command": "python /workspace/Wan2.2/generate.py"
+        "pipeline": wan.WanTI2V,
+        "t5_cpu": True
     },
     "t2v-A14B": {
         "path": MODELS_DIR / "Wan2.2-T2V-A14B",
         "default_size": "1280*720",
-        "alt_size": "854*480",
+        "alt_size": "832*480",
         "supports_t2v": True,
         "supports_i2v": False,
         "vram": "80GB",
-        "command": "python /workspace/Wan2.2/generate.py"
+        "pipeline": wan.WanT2V,
+        "t5_cpu": False
     },
     "i2v-A14B": {
         "path": MODELS_DIR / "Wan2.2-I2V-A14B",
         "default_size": "1280*720",
-        "alt_size": "854*480",
+        "alt_size": "832*480",
         "supports_t2v": False,
         "supports_i2v": True,
         "vram": "80GB",
-        "command": "python /workspace/Wan2.2/generate.py"
+        "pipeline": wan.WanI2V,
+        "t5_cpu": False
     }
 }
 
+# libjpeg-turbo SIMD decoder for JPEG input images
+JPEG_DECODER = TurboJPEG()
+JPEG_SOI = b"\xff\xd8"
+
+# Loaded Wan pipelines, keyed by (model_name, checkpoint dir)
+MODEL_CACHE = {}
+
+# One download at a time per model, concurrent jobs share one local_dir
+DOWNLOAD_LOCKS = {name: threading.Lock() for name in MODEL_CONFIGS}
+
+# Text encoders and VAEs shared across pipelines, keyed by checkpoint file
+SHARED_COMPONENTS = {}
+
+# DiT attributes on Wan pipelines (TI2V has one model, A14B has two experts)
+DIT_ATTRS = ("model", "high_noise_model", "low_noise_model")
+
 def check_wan_installation():
-    """Verify Wan 2.2 is installed"""
-    wan_path = Path("/workspace/Wan2.2")
-    generate_script = wan_path / "generate.py"
-    
-    if not wan_path.exists():
-        print("⚠️ Wan 2.2 not found at /workspace/Wan2.2")
-        print("📥 Cloning Wan 2.2 repository...")
-        subprocess.run([
-            "git", "clone", 
-            "https://github.com/Wan-Video/Wan2.2.git",
-            str(wan_path)
-        ], check=True)
-        
-        print("📦 Installing dependencies...")
-        subprocess.run([
-            "pip", "install", "-r", 
-            str(wan_path / "requirements.txt")
-        ], check=True)
-    
-    return generate_script.exists()
+    """Verify Wan 2.2 is installed (cloned into the Docker image at build time)"""
+    return (WAN_DIR / "wan").is_dir()
 
 def download_model_if_needed(model_name):
     """Download model if not present"""
@@ -79,106 +146,420 @@ def download_model_if_needed(model_name):
     
     model_path = config["path"]
     
-    if model_path.exists():
-        print(f"✅ Model found: {model_path}")
+    with DOWNLOAD_LOCKS[model_name]:
+        if model_path.exists():
+            print(f"✅ Model found: {model_path}")
+            return True
+        
+        print(f"📥 Downloading {model_name}...")
+        
+        # Convert model name to HuggingFace format
+        hf_name = f"Wan-AI/Wan2.2-{model_name.upper()}"
+        
+        # Shards download in parallel, errors raise instead of returning a code
+        snapshot_download(repo_id=hf_name, local_dir=str(model_path), max_workers=8)
+        
+        print(f"✅ Model downloaded: {model_path}")
         return True
+
+def decode_image(image_base64):
+    """Decode base64 input image to RGB in memory, JPEGs via libjpeg-turbo"""
+    # Strip a data URI prefix with a zero-copy view instead of slicing the string
+    data = image_base64.encode("ascii")
+    prefix_end = data.find(b"base64,")
+    start = prefix_end + len(b"base64,") if prefix_end >= 0 else 0
     
-    print(f"📥 Downloading {model_name}...")
+    image_bytes = pybase64.b64decode(memoryview(data)[start:], validate=False)
     
-    # Convert model name to HuggingFace format
-    hf_name = f"Wan-AI/Wan2.2-{model_name.upper()}"
+    if image_bytes[:2] == JPEG_SOI:
+        try:
+            return Image.fromarray(JPEG_DECODER.decode(image_bytes, pixel_format=TJPF_RGB))
+        except OSError:
+            # e.g. CMYK JPEGs, which PIL can still convert
+            pass
     
-    subprocess.run([
-        "huggingface-cli", "download",
-        hf_name,
-        "--local-dir", str(model_path)
-    ], check=True)
+    return Image.open(BytesIO(image_bytes)).convert("RGB")
+
+def fit_image_to_size(image, size):
+    """Resize and center-crop an image to a Wan size string ("W*H")"""
+    width, height = map(int, size.split("*"))
+    return ImageOps.fit(image, (width, height), Image.LANCZOS)
+
+def encode_file_b64_stream(path, chunk_size=3 * 65536):
+    """
+    Base64-encode a memory-mapped file in chunks instead of reading it whole
+    chunk_size must be a multiple of 3 so padding only appears at the end
+    """
+    encoded = bytearray()
+    
+    with open(path, "rb") as f:
+        # mmap of an empty file is not allowed
+        if os.fstat(f.fileno()).st_size == 0:
+            return ""
+        
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            # memoryview slices are zero-copy views into the page cache
+            for offset in range(0, len(view), chunk_size):
+                encoded += pybase64.b64encode(view[offset:offset + chunk_size])
     
-    print(f"✅ Model downloaded: {model_path}")
-    return True
+    return encoded.decode("ascii")
 
-def save_temp_image(image_base64):
-    """Save base64 image to temp file"""
-    if "base64," in image_base64:
-        image_base64 = image_base64.split("base64,")[1]
+def upload_video(video_path, job_id):
+    """Upload video to the configured bucket and return a presigned URL"""
+    key = f"wan22/{job_id}/{Path(video_path).name}"
     
-    image_bytes = base64.b64decode(image_base64)
+    S3_CLIENT.upload_file(
+        str(video_path), BUCKET_NAME, key,
+        ExtraArgs={"ContentType": "video/mp4"}
+    )
     
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg", mode='wb') as f:
-        f.write(image_bytes)
-        return f.name
+    return S3_CLIENT.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": BUCKET_NAME, "Key": key},
+        ExpiresIn=BUCKET_URL_EXPIRY
+    )
+
+def select_dtype():
+    """bf16 on Ampere/Hopper and newer, fp16 on older GPUs without bf16 tensor cores"""
+    if torch.cuda.get_device_capability()[0] >= 8:
+        return torch.bfloat16
+    return torch.float16
 
-def run_wan_generate(model_name, params):
+def get_dit_models(pipeline):
+    """Return the diffusion transformer(s) of a Wan pipeline"""
+    return [getattr(pipeline, attr) for attr in DIT_ATTRS if hasattr(pipeline, attr)]
+
+def quantize_pipeline(pipeline):
+    """Apply torchao weight-only quantization to the DiT (WAN_QUANT)"""
+    # torchao 0.7 (pinned for torch 2.5) predates the Int8WeightOnlyConfig classes
+    from torchao.quantization import quantize_, int8_weight_only, float8_weight_only
+    
+    quant_configs = {
+        "int8": int8_weight_only,
+        "fp8": float8_weight_only
+    }
+    
+    if WAN_QUANT not in quant_configs:
+        raise ValueError(f"Unknown WAN_QUANT: {WAN_QUANT}. Available: {list(quant_configs.keys())}")
+    
+    # FP8 matmuls need Ada/Hopper (sm_89+)
+    if WAN_QUANT == "fp8" and torch.cuda.get_device_capability() < (8, 9):
+        raise ValueError(f"WAN_QUANT=fp8 needs compute capability 8.9+ (H100/L40S/RTX 4090), "
+                         f"got {torch.cuda.get_device_capability()}. Use int8 instead")
+    
+    for dit in get_dit_models(pipeline):
+        quantize_(dit, quant_configs[WAN_QUANT]())
+    
+    print(f"🗜️ DiT quantized to {WAN_QUANT}")
+
+def compile_pipeline(pipeline):
+    """torch.compile the DiT in place so Wan's own calls pick it up"""
+    for dit in get_dit_models(pipeline):
+        dit.compile(fullgraph=False, dynamic=False)
+    
+    print("⚙️ DiT compiled (first generation per size triggers compilation)")
+
+class CachedTextEncoder:
+    """
+    LRU cache in front of Wan's T5 encoder
+    Repeated prompts (seed sweeps, the fixed negative prompt) skip the encoder pass
+    Embeddings stay on the device they were encoded on
+    """
+    
+    def __init__(self, encoder, maxsize):
+        self.encoder = encoder
+        self._encode = functools.lru_cache(maxsize=maxsize)(self._encode_one)
+    
+    def _encode_one(self, text, device):
+        return self.encoder([text], device)[0]
+    
+    def __call__(self, texts, device):
+        return [self._encode(text, device) for text in texts]
+    
+    def __getattr__(self, name):
+        # Wan moves the encoder through .model between CPU and GPU
+        return getattr(self.encoder, name)
+
+def share_components(pipeline, cfg, t5_cpu):
     """
-    Run official Wan 2.2 generate.py script
-    This ensures 100% compatibility with official implementation
+    Swap in a T5 encoder / VAE already loaded for another model
+    All Wan 2.2 models use the same umt5-xxl weights and both A14B models the same VAE
+    """
+    shared_keys = {
+        # t5_cpu pipelines run the encoder on the CPU, others move it to the GPU
+        "text_encoder": ("text_encoder", cfg.t5_checkpoint, t5_cpu),
+        "vae": ("vae", cfg.vae_checkpoint)
+    }
+    
+    for attr, key in shared_keys.items():
+        if key in SHARED_COMPONENTS:
+            setattr(pipeline, attr, SHARED_COMPONENTS[key])
+            print(f"♻️ Reusing shared {attr} ({key[1]})")
+        else:
+            SHARED_COMPONENTS[key] = getattr(pipeline, attr)
+    
+    # Release the duplicate copies that were just loaded
+    torch.cuda.empty_cache()
+
+def load_model(model_name):
+    """
+    Load official Wan 2.2 pipeline once per worker
+    Later jobs reuse the cached pipeline instead of reloading weights
     """
     config = MODEL_CONFIGS[model_name]
+    cache_key = (model_name, str(config["path"]))
+    
+    if cache_key in MODEL_CACHE:
+        return MODEL_CACHE[cache_key]
+    
+    print(f"🔄 Loading {model_name} from {config['path']}...")
     
-    # Build command exactly as in official docs
-    cmd = [
-        "python3", "/workspace/Wan2.2/generate.py",
-        "--task", model_name,
-        "--size", params["size"],
-        "--ckpt_dir", str(config["path"]),
-        "--offload_model", "True",
-        "--convert_model_dtype"
-    ]
-    
-    # Add TI2V-specific flag
-    if model_name == "ti2v-5B":
-        cmd.extend(["--t5_cpu"])
-    
-    # Add prompt
-    if params.get("prompt"):
-        cmd.extend(["--prompt", params["prompt"]])
-    
-    # Add image if provided (for I2V or TI2V)
-    if params.get("image_path"):
-        cmd.extend(["--image", params["image_path"]])
-    
-    # Add seed if provided
-    if params.get("seed"):
-        cmd.extend(["--seed", str(params["seed"])])
-    
-    print(f"🎬 Running command: {' '.join(cmd)}")
-    
-    # Run generation
-    result = subprocess.run(
-        cmd,
-        capture_output=True,
-        text=True,
-        cwd="/workspace/Wan2.2"
+    # DiT compute dtype picked per GPU (official configs assume bf16)
+    cfg = copy.deepcopy(WAN_CONFIGS[model_name])
+    cfg.param_dtype = select_dtype()
+    
+    # Same construction generate.py uses for a single GPU
+    pipeline = config["pipeline"](
+        config=cfg,
+        checkpoint_dir=str(config["path"]),
+        device_id=0,
+        rank=0,
+        t5_cpu=config["t5_cpu"],
+        convert_model_dtype=True
     )
     
-    if result.returncode != 0:
-        print(f"❌ Generation failed: {result.stderr}")
-        raise Exception(f"Generation failed: {result.stderr}")
+    # Wrapped before sharing so models sharing an encoder also share its cache
+    if PROMPT_CACHE_SIZE > 0:
+        pipeline.text_encoder = CachedTextEncoder(pipeline.text_encoder, PROMPT_CACHE_SIZE)
+    
+    if WAN_SHARE_COMPONENTS:
+        share_components(pipeline, cfg, config["t5_cpu"])
+    
+    if WAN_QUANT:
+        quantize_pipeline(pipeline)
+    
+    if WAN_COMPILE:
+        compile_pipeline(pipeline)
+    
+    MODEL_CACHE[cache_key] = pipeline
+    print(f"✅ Model loaded: {model_name}")
+    return pipeline
+
+def write_video(frames, copy_done, output_path, fps):
+    """Encode uint8 [F, H, W, C] frames to MP4 once the device-to-host copy has finished"""
+    copy_done.synchronize()
+    
+    writer = imageio.get_writer(str(output_path), fps=fps, codec="libx264", quality=8)
+    try:
+        for frame in frames.numpy():
+            writer.append_data(frame)
+    finally:
+        writer.close()
+    
+    return output_path
+
+def discard_video(output_path, write_future):
+    """Done-callback deleting a job's MP4 once the writer finishes, for jobs nobody waits on anymore"""
+    output_path.unlink(missing_ok=True)
+
+def build_generate_kwargs(model_name, size, img=None, seed=-1, offload_model=True, sampling_steps=None):
+    """
+    Build pipeline.generate() kwargs
+    Uses the same defaults generate.py falls back to when flags are omitted
+    """
+    config = MODEL_CONFIGS[model_name]
+    cfg = WAN_CONFIGS[model_name]
+    
+    kwargs = {
+        "frame_num": cfg.frame_num,
+        "shift": cfg.sample_shift,
+        "sample_solver": "unipc",
+        "sampling_steps": sampling_steps or cfg.sample_steps,
+        "guide_scale": cfg.sample_guide_scale,
+        "seed": seed,
+        "offload_model": offload_model
+    }
+    
+    # T2V pipelines take an explicit size, I2V pipelines a max area
+    if config["supports_t2v"]:
+        kwargs["size"] = SIZE_CONFIGS[size]
+    
+    if config["supports_i2v"]:
+        kwargs["max_area"] = MAX_AREA_CONFIGS[size]
+        kwargs["img"] = img
+    
+    return kwargs
+
+def warmup_model(model_name):
+    """
+    Run short throwaway generations at the default size
+    Compiles the DiT before the first job instead of during it
+    One run per supported mode, since I2V latents are shaped by the input image
+    """
+    config = MODEL_CONFIGS[model_name]
+    size = config["default_size"]
+    width, height = map(int, size.split("*"))
+    
+    warmup_images = []
+    if config["supports_t2v"]:
+        warmup_images.append(None)
+    if config["supports_i2v"]:
+        # Same shape jobs get after fit_image_to_size
+        warmup_images.append(Image.new("RGB", (width, height)))
+    
+    print(f"🔥 Warming up {model_name} ({size})...")
+    
+    for img in warmup_images:
+        kwargs = build_generate_kwargs(model_name, size, img=img, seed=0, sampling_steps=WARMUP_STEPS)
+        load_model(model_name).generate("warmup", **kwargs)
+    
+    print(f"✅ Warmup done: {model_name}")
+
+def run_wan_generate(model_name, params, offload_model=True):
+    """
+    Run official Wan 2.2 pipeline in-process
+    Uses the same arguments and defaults as the official generate.py
+    """
+    cfg = WAN_CONFIGS[model_name]
+    pipeline = load_model(model_name)
+    size = params["size"]
+    
+    kwargs = build_generate_kwargs(
+        model_name, size,
+        img=params.get("image"),
+        seed=params["seed"],
+        offload_model=offload_model
+    )
+    
+    print(f"🎬 Generating with {model_name} ({size})")
+    
+    video = pipeline.generate(params.get("prompt") or "", **kwargs)
+    
+    output_path = params["output_path"]
+    
+    # [C, F, H, W] in [-1, 1] -> uint8 [F, H, W, C] on the GPU, same mapping as Wan's save_video
+    frames = video.clamp(-1, 1).add(1).mul(127.5).to(torch.uint8).permute(1, 2, 3, 0).contiguous()
+    
+    # Async copy into pinned memory (reused by torch's caching host allocator)
+    pinned = torch.empty(frames.shape, dtype=torch.uint8, pin_memory=True)
+    pinned.copy_(frames, non_blocking=True)
+    copy_done = torch.cuda.Event()
+    copy_done.record()
     
     print(f"✅ Generation completed")
-    print(result.stdout)
     
-    # Find output video (Wan saves to outputs/ directory)
-    output_dir = Path("/workspace/Wan2.2/outputs")
+    # Encode on a CPU thread so the GPU thread can start the next job
+    return WRITER_EXECUTOR.submit(write_video, pinned, copy_done, output_path, cfg.sample_fps)
+
+def report_progress(job_id, message):
+    """Surface the job's current stage in RunPod's /status output"""
+    runpod.serverless.progress_update({"id": job_id}, message)
+
+def run_batch(model_name, batch):
+    """
+    Run a group of jobs for one model back-to-back on the GPU
+    Weights are only offloaded after the last job instead of after every job
+    Jobs cancelled while waiting are skipped
+    Returns one video write future, exception or None (skipped) per job
+    """
+    results = []
+    
+    for i, (params, future) in enumerate(batch):
+        if future.done():
+            print(f"⏭️ Skipping cancelled job {params['job_id']}")
+            results.append(None)
+            continue
+        
+        try:
+            report_progress(params["job_id"], "generating")
+            results.append(run_wan_generate(model_name, params, offload_model=(i == len(batch) - 1)))
+        except Exception as e:
+            results.append(e)
     
-    # Find most recent video file
-    video_files = sorted(output_dir.glob("*.mp4"), key=lambda x: x.stat().st_mtime, reverse=True)
+    return results
+
+class JobBatcher:
+    """
+    Dynamic batcher for concurrent jobs
+    Jobs for the same model arriving within the window (or until the group
+    is full) are handed to the GPU thread together
+    """
     
-    if not video_files:
-        raise Exception("No output video found")
+    def __init__(self, window_ms, max_size):
+        self.window = window_ms / 1000
+        self.max_size = max_size
+        self.pending = {}
+    
+    async def submit(self, model_name, params):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        
+        batch = self.pending.setdefault(model_name, [])
+        batch.append((params, future))
+        
+        if len(batch) >= self.max_size:
+            self._flush(model_name, batch)
+        elif len(batch) == 1:
+            loop.call_later(self.window, self._flush, model_name, batch)
+        
+        return await future
+    
+    def _flush(self, model_name, batch):
+        # Timer may fire after the group was already flushed for being full
+        if self.pending.get(model_name) is not batch:
+            return
+        
+        del self.pending[model_name]
+        asyncio.get_running_loop().create_task(self._run(model_name, batch))
+    
+    async def _run(self, model_name, batch):
+        loop = asyncio.get_running_loop()
+        
+        print(f"📦 Running {len(batch)} job(s) for {model_name}")
+        
+        try:
+            results = await loop.run_in_executor(
+                GPU_EXECUTOR, run_batch, model_name, batch
+            )
+        except Exception as e:
+            results = [e] * len(batch)
+        
+        for (params, future), result in zip(batch, results):
+            # Job was cancelled or timed out while waiting, drop its video once written
+            if future.done():
+                if result is not None and not isinstance(result, Exception):
+                    result.add_done_callback(functools.partial(discard_video, params["output_path"]))
+                continue
+            
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+BATCHER = JobBatcher(BATCH_WINDOW_MS, MAX_BATCH_SIZE)
+
+def deliver_video(video_path, job_id, as_base64):
+    """Upload video to the bucket, or encode it as a base64 data URI"""
+    if not as_base64:
+        return {"video_url": upload_video(video_path, job_id)}
     
-    return video_files[0]
+    video_base64 = encode_file_b64_stream(video_path)
+    return {"video": f"data:video/mp4;base64,{video_base64}"}
 
-def generate_video(job):
+async def generate_video(job):
     """
     Main handler - Routes to correct Wan 2.2 model
     """
     job_input = job["input"]
     
+    # One file per job id, safe with concurrent jobs
+    output_video_path = OUTPUT_DIR / f"wan_{job['id']}.mp4"
+    write_future = None
+    
     try:
         # Check Wan installation
         if not check_wan_installation():
-            raise Exception("Wan 2.2 installation failed")
+            raise Exception(f"Wan 2.2 not found at {WAN_DIR} (rebuild the image)")
         
         # Parse input
         model_name = job_input.get("model", "ti2v-5B")  # Default to TI2V-5B
@@ -191,8 +572,8 @@ def generate_video(job):
         
         config = MODEL_CONFIGS[model_name]
         
-        # Download model if needed
-        download_model_if_needed(model_name)
+        # Download model if needed (off the event loop, can take minutes)
+        await asyncio.to_thread(download_model_if_needed, model_name)
         
         # Determine task mode
         has_image = bool(image_base64)
@@ -208,51 +589,74 @@ def generate_video(job):
         
         # Prepare parameters
         params = {
+            "job_id": job["id"],
+            "output_path": output_video_path,
             "size": job_input.get("size", config["default_size"]),
             "prompt": prompt if prompt else None,
             "seed": job_input.get("seed")
         }
         
-        # Save image to temp file if provided
+        # Resolve the seed here so it can be reported back and reproduced
+        # (accepts "42" like generate.py's --seed did)
+        if params["seed"] is None:
+            params["seed"] = random.randint(0, 2**31 - 1)
+        else:
+            params["seed"] = int(params["seed"])
+            if params["seed"] < 0:
+                raise ValueError(f"seed must be >= 0, got {params['seed']}")
+        
+        # Compiled workers only accept the two pinned sizes
+        if WAN_COMPILE:
+            allowed_sizes = [config["default_size"], config["alt_size"]]
+        else:
+            allowed_sizes = list(SUPPORTED_SIZES[model_name])
+        
+        if params["size"] not in allowed_sizes:
+            raise ValueError(f"Unsupported size for {model_name}: {params['size']}. Available: {allowed_sizes}")
+        
+        # Decode image in memory if provided
         if image_base64:
-            params["image_path"] = save_temp_image(image_base64)
+            params["image"] = await asyncio.to_thread(decode_image, image_base64)
+            
+            # I2V latent shapes follow the image's aspect ratio, so pin it to the
+            # size as well or every new aspect ratio recompiles the DiT
+            if WAN_COMPILE:
+                params["image"] = await asyncio.to_thread(fit_image_to_size, params["image"], params["size"])
         
         print(f"🎯 Model: {model_name}")
         print(f"📝 Mode: {'Text-to-Video' if is_t2v else 'Image-to-Video'}")
         print(f"📏 Size: {params['size']}")
         print(f"💬 Prompt: {params.get('prompt', 'None')[:50]}...")
         
-        # Run generation using official script
-        output_video_path = run_wan_generate(model_name, params)
+        # Run generation using official pipeline (grouped with concurrent jobs)
+        # then wait for its MP4 to finish encoding in the background
+        report_progress(job["id"], "queued")
+        write_future = await BATCHER.submit(model_name, params)
+        await asyncio.wrap_future(write_future)
         
-        # Convert video to base64
-        with open(output_video_path, "rb") as f:
-            video_bytes = f.read()
-            video_base64 = base64.b64encode(video_bytes).decode('utf-8')
-        
-        # Cleanup
-        if params.get("image_path"):
-            os.unlink(params["image_path"])
-        
-        os.unlink(output_video_path)
+        # Deliver via bucket URL when configured, base64 otherwise (or on request)
+        # Off the event loop so other jobs can still be accepted
+        as_base64 = S3_CLIENT is None or job_input.get("return_base64", False)
+        report_progress(job["id"], "encoding" if as_base64 else "uploading")
+        output = await asyncio.to_thread(deliver_video, output_video_path, job["id"], as_base64)
         
         print("✅ Video generation successful")
         
         return {
             "status": "success",
-            "video": f"data:video/mp4;base64,{video_base64}",
+            **output,
             "info": {
                 "model": model_name,
                 "mode": "t2v" if is_t2v else "i2v",
                 "size": params["size"],
                 "prompt": params.get("prompt", ""),
-                "fps": 24
+                "seed": params["seed"],
+                "fps": WAN_CONFIGS[model_name].sample_fps
             }
         }
         
     except Exception as e:
         print(f"❌ Error: {e}")
-        import traceback
         traceback.print_exc()
         
         return {
@@ -260,6 +664,48 @@ def generate_video(job):
             "error": str(e),
             "traceback": traceback.format_exc()
         }
+    
+    finally:
+        # Also on failed writes, uploads or encodes, so temp videos don't pile up
+        if output_video_path.exists():
+            os.unlink(output_video_path)
+        
+        # Cancelled mid-encode, the writer keeps going and creates the file later
+        # (runs right away if the write already finished)
+        if write_future is not None:
+            write_future.add_done_callback(functools.partial(discard_video, output_video_path))
+
+def preload_models():
+    """
+    Warm-load models listed in WAN_PRELOAD_TASK (comma separated)
+    Runs before the worker accepts jobs so the first request skips model loading
+    """
+    preload = os.environ.get("WAN_PRELOAD_TASK", "")
+    
+    for model_name in [m.strip() for m in preload.split(",") if m.strip()]:
+        if model_name not in MODEL_CONFIGS:
+            print(f"⚠️ Unknown preload model: {model_name}. Available: {list(MODEL_CONFIGS.keys())}")
+            continue
+        
+        try:
+            download_model_if_needed(model_name)
+            load_model(model_name)
+            
+            # On the GPU thread that later runs the jobs
+            if WAN_COMPILE:
+                GPU_EXECUTOR.submit(warmup_model, model_name).result()
+        except Exception as e:
+            # Jobs will retry the load and report the error
+            print(f"❌ Preload failed for {model_name}: {e}")
+
+def adjust_concurrency(current_concurrency):
+    """Accept enough concurrent jobs to fill a group"""
+    return MAX_BATCH_SIZE
+
+preload_models()
 
 # Start RunPod handler
-runpod.serverless.start({"handler": generate_video})
+runpod.serverless.start({
+    "handler": generate_video,
+    "concurrency_modifier": adjust_concurrency
+})